@@ -0,0 +1,28 @@
+"""Renders the invariant architecture schematic to assets/schematic.png.
+
+The diagram takes no inputs, so there is no reason to pay the matplotlib
+render at request time. Run this once at deploy time — no API keys are
+needed, the chart engine is pure matplotlib:
+
+    python scripts/prerender_diagrams.py
+
+A designer can also hand-edit the emitted PNG afterwards without
+touching any code.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from strategy_core import SCHEMATIC_ASSET, render_system_schematic
+
+
+def main():
+    SCHEMATIC_ASSET.parent.mkdir(parents=True, exist_ok=True)
+    SCHEMATIC_ASSET.write_bytes(render_system_schematic())
+    print(f"Wrote {SCHEMATIC_ASSET} ({SCHEMATIC_ASSET.stat().st_size:,} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+"""Shared engine for the Strategic Intelligence Unit apps.
+
+Everything that is not UI or document assembly lives here: API clients,
+the agent brains (Perplexity + Gemini), text hygiene, and the chart
+engine. Importing this module once per Streamlit process means the
+clients, compiled regexes, style constants, and matplotlib backend init
+all happen exactly once.
+"""
+
+import streamlit as st
+import asyncio
+import functools
+import hashlib
+import io
+import json_repair
+import orjson
+import re
+import tenacity
+import threading
+from diskcache import Cache
+from pathlib import Path
+
+# matplotlib, openai, and google.generativeai are imported lazily inside the
+# functions that need them: together they cost 1-3s of cold import that would
+# otherwise be paid before the user has even typed a company name. Repeat
+# calls hit sys.modules and pay nothing.
+
+# Styling Constants
+CORP_BLUE = "#0F4C81"  # Classic Consulting Blue
+CORP_GREY = "#53565A"
+ACCENT_TEAL = "#00A99D"
+
+# Model Constants
+PPLX_MODEL = "sonar"
+GEMINI_MODEL = "gemini-2.0-flash"     # Flash is 3-5x faster and plenty for a 6-section memo
+GEMINI_FALLBACK_MODEL = "gemini-1.5-pro"  # one retry here if Flash garbles the JSON
+
+# Exact-match LLM response cache: repeat audits of the same company
+# (common while demoing/iterating) replay from disk in ms instead of
+# re-hitting the paid APIs. Disk-backed so it survives Streamlit Cloud's
+# hourly restarts and is shared across user sessions.
+llm_cache = Cache(".cache/llm", size_limit=2 << 30)
+
+# Live market research goes stale fast; a generated memo for the same
+# research is deterministic enough to keep for a week.
+RESEARCH_TTL = 3600
+STRATEGY_TTL = 7 * 86400
+
+def llm_cache_key(*parts):
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+# Static prompt prefix for the Architect. Kept ahead of the dynamic
+# company/research tail so the provider's implicit prefix caching can apply;
+# an explicit Gemini context cache is not an option here — this prefix is
+# ~200 tokens, far below the documented 1,024-token cacheable minimum.
+STRATEGY_SYSTEM_PROMPT = """
+You are a Strategy Director (ex-BCG).
+
+Write a 6-section Strategy Memo for the target company using the research provided.
+RULES:
+1. NO "Dear CEO". Start directly with the strategic thesis.
+2. NO Markdown formatting (no **, no ##).
+3. Professional, dense, 'Amazon-memo' style writing.
+4. Be concise: no filler sentences. Return only the JSON object, no surrounding prose.
+
+JSON Format:
+{
+  "title": "The Transformation Thesis",
+  "executive_summary": "A 200-word high-level abstract. Focus on the 'Why Now'.",
+  "problem_deep_dive": "Analyze the bottleneck. Use the $ numbers from research.",
+  "solution_tech": "Define the AI Agent architecture. Be technical (RAG, Vector DBs, Agents).",
+  "financial_impact": "Projected EBITDA impact or Cost Savings.",
+  "roadmap": "Q1: Pilot -> Q2: Scale -> Q3: Optimize."
+}
+"""
+
+# --- API SETUP ---
+# Secrets are only read inside the client getters below, never at import
+# time: scripts/prerender_diagrams.py imports this module for the chart
+# engine alone and must work without any keys configured. The app does
+# its own fail-fast check before queueing work (see app.py).
+
+def require_api_keys():
+    """Halts the app with a friendly error unless both API keys are configured."""
+    missing = []
+    for name in ("PPLX_KEY", "GEMINI_KEY"):
+        try:
+            st.secrets[name]
+        except Exception:
+            missing.append(name)
+    if missing:
+        st.error(f"⚠️ API Keys Missing. Please add {' and '.join(missing)} to Secrets.")
+        st.stop()
+
+@st.cache_resource
+def get_genai():
+    """Imports and configures the Gemini SDK once per process."""
+    import google.generativeai as genai
+    genai.configure(api_key=st.secrets["GEMINI_KEY"])
+    return genai
+
+@st.cache_resource
+def get_pplx_client():
+    """One Perplexity client per process — reruns reuse the httpx connection pool.
+
+    HTTP/2 with keep-alive skips the ~100-300ms TLS handshake on every call
+    after the first and multiplexes if several queries ever run in parallel.
+    """
+    import httpx
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=st.secrets["PPLX_KEY"],
+        base_url="https://api.perplexity.ai",
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+            timeout=60
+        )
+    )
+
+@st.cache_resource
+def get_gemini_model(name):
+    """One GenerativeModel handle per model name per process."""
+    return get_genai().GenerativeModel(name)
+
+@st.cache_resource
+def get_pipeline_loop():
+    """One persistent event loop on a daemon thread, shared by every session.
+
+    The cached async clients (the httpx pool above, Gemini's grpc aio
+    channel) bind to the first loop they run under, so a throwaway
+    asyncio.run() loop per click leaves them holding a closed loop and the
+    next cache-miss audit dies with "Event loop is closed".
+
+    The thread is shared by all sessions and carries no ScriptRunContext, so
+    nothing running on it may call st.* — pipelines report progress through
+    a queue that the submitting script thread drains (see app.py).
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="pipeline-loop", daemon=True).start()
+    return loop
+
+def submit_async(coro):
+    """Schedules a pipeline coroutine on the persistent loop.
+
+    Returns a concurrent.futures.Future; the script thread renders queued
+    progress events while it waits on the result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_pipeline_loop())
+
+def get_pyplot():
+    """Lazy matplotlib entry point — forces the headless Agg backend."""
+    import matplotlib
+    matplotlib.use("Agg")  # no GUI deps, set before pyplot
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+    return plt, patches
+
+# --- UTILS: HYGIENE & CLEANING ---
+
+# Compiled once: the outermost {...} block, and leading/trailing code fences.
+# One anchored pass beats chained str.replace calls, which also corrupted any
+# content containing the literal substring "json".
+JSON_BLOCK_RE = re.compile(r'\{.*\}', re.S)
+FENCE_RE = re.compile(r'^```(?:python|json)?\s*|\s*```$', re.MULTILINE)
+
+def parse_llm_json(text):
+    """Safely parses JSON from LLM output (never eval — both an RCE hole and slow)."""
+    m = JSON_BLOCK_RE.search(text)
+    raw = m.group(0) if m else FENCE_RE.sub('', text).strip()
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # Auto-fixes trailing commas, unquoted keys, stray fences etc.
+        return json_repair.loads(raw)
+
+# One pattern covering bold **text**, ## headers, and * bullets — a single
+# engine traversal instead of three re.sub passes per section.
+MD_ARTIFACT_RE = re.compile(r'\*\*(.*?)\*\*|##\s?|\n\* ')
+
+def _md_artifact_sub(m):
+    if m.group(1) is not None:
+        return m.group(1)   # unwrap **bold**
+    if m.group(0).startswith('\n'):
+        return '\n• '       # convert * bullets to •
+    return ''               # strip ## headers
+
+def clean_markdown(text):
+    """Removes AI artifacts (**, ##, *) to ensure human-like text."""
+    if not text: return ""
+    return MD_ARTIFACT_RE.sub(_md_artifact_sub, text).strip()
+
+# --- AGENT BRAINS ---
+
+def _is_retryable_llm_error(exc):
+    """Transient quota/connectivity errors from either SDK.
+
+    Matched by class name so the heavy SDK modules stay lazily imported.
+    """
+    return type(exc).__name__ in {
+        # openai / httpx
+        "RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError",
+        # google.api_core
+        "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded",
+    }
+
+# Exponential backoff (2s -> 30s, 4 attempts) so a single transient 429
+# degrades one stage briefly instead of failing the whole pipeline run.
+llm_retry = tenacity.retry(
+    stop=tenacity.stop_after_attempt(4),
+    wait=tenacity.wait_exponential(multiplier=2, min=2, max=30),
+    retry=tenacity.retry_if_exception(_is_retryable_llm_error),
+    reraise=True,
+)
+
+@llm_retry
+async def stream_pplx_text(on_chunk=None, **request):
+    """Streams a Perplexity completion, accumulating the text.
+
+    on_chunk (if given) receives the accumulated text after every delta so
+    the UI can render tokens as they arrive instead of a multi-second blank.
+    """
+    response = await get_pplx_client().chat.completions.create(stream=True, **request)
+    parts = []
+    async for chunk in response:
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            if on_chunk:
+                on_chunk("".join(parts))
+    return "".join(parts)
+
+async def get_deep_research(company, on_chunk=None):
+    """The Hunter: Demands hard data tables from Perplexity."""
+    query = f"""
+    Act as a Forensic Auditor for {company} in 2026.
+    1. FIND THE BLEED: Identify the #1 operational bottleneck costing >$50M.
+    2. GET THE DATA: Provide a CSV-style list of {company}'s Revenue and Net Income for 2022, 2023, 2024, 2025 (Est).
+    3. TECH DEBT: Specific legacy systems (e.g., SAP, Oracle, On-prem) slowing them down.
+    Output strictly factual data. No fluff. Respond in ≤8 bullet points, numbers wherever possible.
+    """
+    key = llm_cache_key(PPLX_MODEL, company.lower().strip())
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+    result = await stream_pplx_text(
+        on_chunk=on_chunk,
+        model=PPLX_MODEL,
+        messages=[{"role": "user", "content": query}],
+        max_tokens=400  # hard data only — decode time is the latency here
+    )
+    llm_cache.set(key, result, expire=RESEARCH_TTL)
+    return result
+
+# JSON schema for the six memo sections — enforced server-side on both models,
+# so a malformed response (and the wasted paid call behind it) can't happen.
+STRATEGY_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "executive_summary": {"type": "string"},
+        "problem_deep_dive": {"type": "string"},
+        "solution_tech": {"type": "string"},
+        "financial_impact": {"type": "string"},
+        "roadmap": {"type": "string"}
+    },
+    "required": ["title", "executive_summary", "problem_deep_dive",
+                 "solution_tech", "financial_impact", "roadmap"]
+}
+
+# Gemini structured-output mode: guaranteed parseable JSON, no markdown fences.
+# Decode time scales linearly with output tokens, so the cap bounds the
+# Architect stage's latency (and cost) directly.
+STRATEGY_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": STRATEGY_RESPONSE_SCHEMA,
+    "max_output_tokens": 1500,
+    "temperature": 0.4
+}
+
+def fallback_strategy(company):
+    """Placeholder memo returned when an LLM stage fails outright — the doc
+    compiler reads all six sections unconditionally, so every path must
+    return a complete dict."""
+    return {
+        "title": f"Strategic Roadmap: {company}",
+        "executive_summary": "Analysis data unavailable. Please retry agent.",
+        "problem_deep_dive": "N/A", "solution_tech": "N/A",
+        "financial_impact": "N/A", "roadmap": "N/A"
+    }
+
+def ensure_strategy_sections(strategy):
+    """Raises unless the parse produced an object with every memo section.
+
+    json_repair happily returns lists/strings for mangled output, and a
+    schema-constrained response can still arrive truncated at max_tokens.
+    """
+    if not isinstance(strategy, dict):
+        raise ValueError("strategy payload is not a JSON object")
+    missing = [k for k in STRATEGY_RESPONSE_SCHEMA["required"] if k not in strategy]
+    if missing:
+        raise ValueError(f"strategy payload missing sections: {missing}")
+    return strategy
+
+# The fused Sonar call returns the same memo plus the raw audit findings.
+FUSED_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"research": {"type": "string"}, **STRATEGY_RESPONSE_SCHEMA["properties"]},
+    "required": ["research"] + STRATEGY_RESPONSE_SCHEMA["required"]
+}
+
+async def get_research_and_strategy(company, on_chunk=None):
+    """Budget path: one Sonar call does both the audit and the memo.
+
+    Fusing the two prompts removes a full dependent LLM roundtrip (~2-5s)
+    and halves token spend versus the Perplexity -> Gemini relay.
+    """
+    key = llm_cache_key(PPLX_MODEL, "fused", company.lower().strip())
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+    query = f"""
+    Act as a Forensic Auditor AND Strategy Director (ex-BCG) for {company} in 2026.
+    STEP 1 — AUDIT (put the raw findings in the "research" field):
+    1. FIND THE BLEED: Identify the #1 operational bottleneck costing >$50M.
+    2. GET THE DATA: {company}'s Revenue and Net Income for 2022, 2023, 2024, 2025 (Est), with $ figures.
+    3. TECH DEBT: Specific legacy systems slowing them down.
+    STEP 2 — MEMO (fill the remaining fields):
+    Write the 6-section Strategy Memo from that data.
+    NO "Dear CEO", NO Markdown formatting, dense 'Amazon-memo' prose.
+    """
+    try:
+        text = await stream_pplx_text(
+            on_chunk=on_chunk,
+            model=PPLX_MODEL,
+            messages=[{"role": "user", "content": query}],
+            response_format={"type": "json_schema", "json_schema": {"schema": FUSED_RESPONSE_SCHEMA}},
+            max_tokens=1500  # audit bullets + six terse memo sections
+        )
+        strategy = ensure_strategy_sections(parse_llm_json(text))
+        research = strategy.pop("research", "")
+        llm_cache.set(key, (research, strategy), expire=RESEARCH_TTL)  # embeds live data
+        return research, strategy
+    except:
+        # Same degrade-to-placeholder contract as get_strategic_narrative;
+        # failures are never cached.
+        return "", fallback_strategy(company)
+
+@llm_retry
+async def stream_gemini_text(model, prompt, generation_config=None, on_chunk=None):
+    """Streams a Gemini response to completion, accumulating the text.
+
+    Network-bound token decode overlaps the CPU-bound chart/docx work
+    running on other tasks instead of blocking until the full response lands;
+    on_chunk lets the UI surface progress while it does.
+    """
+    response = await model.generate_content_async(
+        prompt, stream=True, generation_config=generation_config)
+    parts = []
+    async for chunk in response:
+        parts.append(chunk.text)
+        if on_chunk:
+            on_chunk("".join(parts))
+    return "".join(parts)
+
+async def get_strategic_narrative(company, research, on_chunk=None):
+    """The Architect: Writes in pure Strategy Consulting prose."""
+    key = llm_cache_key(GEMINI_MODEL, company, research)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+    # Dynamic content goes at the END of the prompt so the static prefix stays stable.
+    tail = f"Target Company: {company}\nResearch: {research}"
+    try:
+        model = get_gemini_model(GEMINI_MODEL)
+        text = await stream_gemini_text(model, STRATEGY_SYSTEM_PROMPT + "\n" + tail, STRATEGY_GENERATION_CONFIG, on_chunk)
+        try:
+            strategy = ensure_strategy_sections(parse_llm_json(text))
+        except Exception:
+            # Flash produced unparseable output: retry once on Pro before
+            # giving up.
+            model = get_gemini_model(GEMINI_FALLBACK_MODEL)
+            text = await stream_gemini_text(model, STRATEGY_SYSTEM_PROMPT + "\n" + tail, STRATEGY_GENERATION_CONFIG, on_chunk)
+            strategy = ensure_strategy_sections(parse_llm_json(text))
+        llm_cache.set(key, strategy, expire=STRATEGY_TTL)  # only successful parses are worth replaying
+        return strategy
+    except:
+        return fallback_strategy(company)
+
+# --- VISUALIZATION ENGINE (The "Crazy Good" Upgrade) ---
+
+# Captures in-order (year, $amount) pairs in a single scan of the research text.
+FIN_PAIR_RE = re.compile(r'(202[2-6])[^$]{0,40}\$([\d.]+)', re.S)
+
+# cache_resource shares the pooled Figure across sessions, and the chart
+# renders on to_thread workers — serialize clear->plot->savefig so two
+# concurrent audits can't interleave bars into each other's PNGs.
+_chart_lock = threading.Lock()
+
+@st.cache_resource
+def get_chart_canvas():
+    """One reusable Figure+Axes for the financial chart.
+
+    Allocating the Agg canvas is the expensive part of plt.subplots; reusing
+    it across renders also keeps the backend's text-layout caches warm over a
+    session of repeated company queries.
+    """
+    plt, _ = get_pyplot()
+    return plt.subplots(figsize=(8, 4.5))
+
+def create_premium_chart(research_text):
+    """Parses text for numbers and draws a High-End FinTech Chart.
+
+    Returns the PNG bytes; callers wrap them in a fresh BytesIO per insert
+    (python-pptx/docx deduplicate identical image bytes, so reuse is free).
+    """
+    data = {
+        'Year': ['2022', '2023', '2024', '2025'],
+        'Revenue ($B)': [10.5, 12.1, 14.2, 16.8] # Default fallback if parse fails
+    }
+
+    # Try to extract real numbers if Perplexity found them
+    try:
+        pairs = FIN_PAIR_RE.findall(research_text)[:4]
+        if len(pairs) == 4:
+            data['Year'] = [year for year, _ in pairs]
+            data['Revenue ($B)'] = [float(amount) for _, amount in pairs]
+    except:
+        pass
+
+    # PLOTTING (the data is already two 4-element lists — no DataFrame needed)
+    with _chart_lock:
+        fig, ax = get_chart_canvas()
+        ax.clear()  # wipe the previous render; the figure itself stays pooled
+        bars = ax.bar(data['Year'], data['Revenue ($B)'], color=CORP_BLUE, width=0.5, zorder=3)
+
+        # Minimalist Styling (The "Apple/Stripe" look)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.spines['left'].set_visible(False)
+        ax.spines['bottom'].set_color('#DDDDDD')
+
+        ax.grid(axis='y', linestyle=':', alpha=0.6, zorder=0)
+        ax.set_title("Financial Trajectory & Growth Vector", loc='left', fontsize=12, fontweight='bold', color=CORP_GREY, pad=15)
+
+        # Direct Labeling
+        for bar in bars:
+            height = bar.get_height()
+            ax.text(bar.get_x() + bar.get_width()/2., height + 0.1,
+                    f'${height}B', ha='center', va='bottom', fontsize=10, color=CORP_BLUE, fontweight='bold')
+
+        # 150 dpi is visually identical at the brief's 6-inch display width and
+        # cuts PNG encode CPU and payload ~4x versus 300 dpi.
+        img_buf = io.BytesIO()
+        fig.savefig(img_buf, format='png', dpi=150, bbox_inches='tight')
+        return img_buf.getvalue()
+
+@functools.lru_cache(maxsize=1)
+def render_system_schematic():
+    """Renders the Architecture Diagram PNG once per process (it has no inputs)."""
+    plt, patches = get_pyplot()
+    fig, ax = plt.subplots(figsize=(9, 5))
+    ax.axis('off')
+    ax.set_xlim(0, 10)
+    ax.set_ylim(0, 6)
+
+    # Helper for rounded boxes
+    def draw_box(x, y, w, h, text, color="#EEF5FB", ec=CORP_BLUE):
+        box = patches.FancyBboxPatch((x, y), w, h, boxstyle="round,pad=0.2",
+                                     linewidth=1.5, edgecolor=ec, facecolor=color)
+        ax.add_patch(box)
+        ax.text(x + w/2, y + h/2, text, ha='center', va='center', fontsize=9, fontweight='bold', color=CORP_GREY)
+
+    # 1. The Core (AI Brain)
+    draw_box(4, 2.5, 2, 1, "Agentic\nOrchestrator", color=CORP_BLUE, ec="none")
+    ax.text(5, 3, "Gemini 2.5 Pro", ha='center', va='center', fontsize=8, color="white", fontweight='bold')
+
+    # 2. Inputs (Left)
+    draw_box(0.5, 4, 2, 0.8, "Live Market Data\n(Perplexity)")
+    draw_box(0.5, 1, 2, 0.8, "Internal ERP\n(SQL/SAP)")
+
+    # 3. Outputs (Right)
+    draw_box(7.5, 4, 2, 0.8, "Executive\nDashboard")
+    draw_box(7.5, 1, 2, 0.8, "Auto-Action\nTriggers")
+
+    # 4. Connectors (Curved lines using annotate)
+    style = "Simple, tail_width=0.5, head_width=4, head_length=8"
+    kw = dict(arrowstyle=style, color=CORP_GREY, alpha=0.5)
+
+    # Connecting Arrows
+    ax.add_patch(patches.FancyArrowPatch((2.8, 4.4), (3.9, 3.5), connectionstyle="arc3,rad=-0.2", **kw)) # Top Left -> Mid
+    ax.add_patch(patches.FancyArrowPatch((2.8, 1.4), (3.9, 2.5), connectionstyle="arc3,rad=0.2", **kw))  # Bot Left -> Mid
+    ax.add_patch(patches.FancyArrowPatch((6.1, 3.5), (7.4, 4.4), connectionstyle="arc3,rad=-0.2", **kw)) # Mid -> Top Right
+    ax.add_patch(patches.FancyArrowPatch((6.1, 2.5), (7.4, 1.4), connectionstyle="arc3,rad=0.2", **kw))  # Mid -> Bot Right
+
+    ax.text(5, 5.5, "Proposed AI Architecture: The 'Neuro-Symbolic' Core", ha='center', fontsize=14, fontweight='bold', color=CORP_GREY)
+
+    img_buf = io.BytesIO()
+    fig.savefig(img_buf, format='png', dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    return img_buf.getvalue()
+
+# Deploy-time render of the schematic (see scripts/prerender_diagrams.py).
+SCHEMATIC_ASSET = Path(__file__).parent / "assets" / "schematic.png"
+
+@functools.lru_cache(maxsize=1)
+def load_schematic_png():
+    """Prefers the pre-rendered PNG shipped in assets/; falls back to a live
+    render when it is missing (e.g. fresh checkout before prerendering).
+
+    lru_cache rather than st.cache_data: this runs on the pipeline's worker
+    threads, which have no ScriptRunContext for the Streamlit cache to use.
+    """
+    if SCHEMATIC_ASSET.exists():
+        return SCHEMATIC_ASSET.read_bytes()
+    return render_system_schematic()
+
+def create_system_schematic():
+    """Wraps the cached schematic PNG in a fresh BytesIO for each consumer."""
+    return io.BytesIO(load_schematic_png())